@@ -2,12 +2,60 @@
 RunPod Serverless Handler for ACE-Step 1.5 Music Generation
 """
 
+import asyncio
+import concurrent.futures
+import contextlib
+import importlib
+import inspect
+import os
+import queue
 import sys
+import threading
+import time
 import traceback
 
 # Early error logging
 print("Starting ACE-Step 1.5 handler...", flush=True)
 
+
+def _setup_compile_cache(volume="/runpod-volume"):
+    """
+    Persist Triton/Inductor compile artifacts across container restarts.
+
+    Prefers the RunPod network volume when one is attached; explicit
+    TRITON_CACHE_DIR/TORCHINDUCTOR_CACHE_DIR settings win.
+    """
+    if os.path.isdir(volume):
+        cache_root = os.path.join(volume, "acestep_cache")
+    else:
+        cache_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "acestep")
+    os.environ.setdefault("TRITON_CACHE_DIR", os.path.join(cache_root, "triton"))
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.join(cache_root, "torchinductor"))
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+    os.environ.setdefault("TORCHINDUCTOR_AUTOGRAD_CACHE", "1")
+    for cache_dir in (os.environ["TRITON_CACHE_DIR"], os.environ["TORCHINDUCTOR_CACHE_DIR"]):
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+        except Exception:
+            # Best-effort: do not block startup if directory creation fails.
+            pass
+    print(f"Compile cache: {os.environ['TORCHINDUCTOR_CACHE_DIR']}", flush=True)
+
+
+_setup_compile_cache()
+
+# Single-GPU worker: a few CPU threads are enough, and defaulting to one per vCPU
+# oversubscribes the host during transfers/encoding. OMP/MKL must be set before torch loads.
+CPU_THREADS = int(os.getenv("ACESTEP_CPU_THREADS", "2"))
+
+
+def _limit_cpu_threads(num_threads):
+    for thread_var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "NUMBA_NUM_THREADS"):
+        os.environ.setdefault(thread_var, str(num_threads))
+
+
+_limit_cpu_threads(CPU_THREADS)
+
 try:
     import runpod
     print("runpod imported successfully", flush=True)
@@ -17,6 +65,9 @@ except ImportError as e:
 
 try:
     import torch
+    from torch.nn.attention import SDPBackend, sdpa_kernel
+    torch.set_num_threads(CPU_THREADS)
+    torch.set_num_interop_threads(1)
     print(f"torch imported successfully (version: {torch.__version__})", flush=True)
     print(f"CUDA available: {torch.cuda.is_available()}", flush=True)
     if torch.cuda.is_available():
@@ -28,65 +79,402 @@ except ImportError as e:
 try:
     import base64
     import io
-    from scipy.io import wavfile
-    print("scipy imported successfully", flush=True)
+    import numba
+    import numpy as np
+    import soundfile as sf
+    import struct
+    print("audio libraries imported successfully", flush=True)
 except ImportError as e:
-    print(f"Failed to import scipy: {e}", flush=True)
+    print(f"Failed to import audio libraries: {e}", flush=True)
     sys.exit(1)
 
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def _normalize_to_int16(x, out):
+    """
+    Quantize float audio to int16, scaling down only if the peak exceeds 1.0.
+
+    Args:
+        x: Flat float32 audio buffer
+        out: Flat int16 output buffer of the same size
+    """
+    peak = 0.0
+    for i in numba.prange(x.size):
+        peak = max(peak, abs(x[i]))
+    scale = 32767.0 / peak if peak > 1.0 else 32767.0
+    for i in numba.prange(x.size):
+        out[i] = np.int16(x[i] * scale)
+
+
+def to_int16(audio_np):
+    """Convert float audio in [-1, 1] to int16 PCM in a single fused kernel"""
+    audio_np = np.ascontiguousarray(audio_np, dtype=np.float32)
+    audio_int16 = np.empty(audio_np.shape, dtype=np.int16)
+    _normalize_to_int16(audio_np.reshape(-1), audio_int16.reshape(-1))
+    return audio_int16
+
+
+def _quantize_int16(x):
+    # Upcast bf16/fp16 output first so the peak and scale are exact; the cast fuses into the kernel
+    x = x.float()
+    peak = x.abs().amax().clamp(min=1.0)
+    return (x * (32767.0 / peak)).to(torch.int16)
+
+
+# Inductor fuses abs/amax/scale/cast into one kernel writing int16 directly.
+# dynamic=True because audio length varies per job (CUDA graphs would recapture per shape).
+_quantize_int16_compiled = torch.compile(_quantize_int16, fullgraph=True, dynamic=True)
+
+
+def write_wav(buf, rate, pcm_int16):
+    """Write int16 PCM ([samples] or ACE-Step's [channels, samples]) as a WAV file: 44-byte header + raw data"""
+    channels = 1 if pcm_int16.ndim == 1 else pcm_int16.shape[0]
+    # WAV data is interleaved frames, i.e. [samples, channels] in C order
+    pcm = np.ascontiguousarray(pcm_int16.T if pcm_int16.ndim == 2 else pcm_int16, dtype="<i2")
+    data_size = pcm.size * 2
+    buf.write(struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", 36 + data_size, b"WAVE",
+        b"fmt ", 16, 1, channels, rate, rate * channels * 2, channels * 2, 16,
+        b"data", data_size,
+    ))
+    buf.write(pcm.data)
+
+
+# Worker-scoped buffers reused across jobs instead of reallocating multi-MB outputs per job
+_pinned_int16 = None
+_audio_buffer = io.BytesIO()
+
+
+def _get_pinned_int16(numel):
+    """Return a pinned int16 host buffer of at least numel elements, growing it only when needed"""
+    global _pinned_int16
+    if _pinned_int16 is None or _pinned_int16.numel() < numel:
+        _pinned_int16 = torch.empty(numel, dtype=torch.int16, pin_memory=True)
+    return _pinned_int16
+
+
+def to_int16_gpu(audio):
+    """
+    Quantize a CUDA float tensor to int16 on device and copy only the int16 result to host.
+
+    The returned array is a view into the shared pinned buffer and is only valid until the next call.
+    """
+    quantize = _quantize_int16_compiled if COMPILE_MODEL else _quantize_int16
+    audio_int16 = quantize(audio)
+    host = _get_pinned_int16(audio_int16.numel())[:audio_int16.numel()].view(audio_int16.shape)
+    host.copy_(audio_int16, non_blocking=True)
+    torch.cuda.current_stream().synchronize()
+    return host.numpy()
+
+
+def _env_bool(name, default):
+    v = os.getenv(name)
+    if v is None:
+        return default
+    return v.strip().lower() in {"1", "true", "yes", "y", "on"}
+
+
+# Module providing ACEStepPipeline, selected once via ACESTEP_BACKEND
+PIPELINE_BACKENDS = {
+    "v15": "acestep.pipeline",
+    "v15_old": "acestep.acestep_v15_pipeline",
+}
+BACKEND = os.getenv("ACESTEP_BACKEND", "v15").strip().lower()
+
+# torch.compile the pipeline's transformer/VAE/text encoder (static shapes, no CUDA graphs)
+COMPILE_MODEL = _env_bool("ACESTEP_COMPILE", False)
+
+# Output sample rate of the ACE-Step 1.5 VAE (AceStepHandler.sample_rate)
+SAMPLE_RATE = 48000
+
+# Fixed generation lengths (seconds) used when compiling, so each bucket compiles once
+DURATION_BUCKETS = (30, 60, 120, 180)
+
+# Opt-in torchao weight-only quantization for the transformer: int8_weight_only, fp8_weight_only or none
+QUANTIZATION = os.getenv("ACESTEP_QUANTIZATION", "none").strip().lower()
+
+# Opt-in bf16 VAE decode: audio leaves the VAE at half the bytes (inputs cast via autocast)
+BF16_VAE = _env_bool("ACESTEP_BF16_VAE", False)
+
+# Precision-sensitive linears (attention QK and final projections) stay in bf16
+QUANT_SKIP_PATTERNS = ("q_proj", "k_proj", "proj_out", "final_layer", "lm_head")
+
+# Fused SDPA kernels only; the math backend materializes the full attention matrix
+SDPA_BACKENDS = [SDPBackend.CUDNN_ATTENTION, SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION]
+
+# Response encodings (format name -> soundfile format, subtype); FLAC is lossless and ~half the size of WAV
+AUDIO_FORMATS = {
+    "flac": ("FLAC", None),
+    "wav": ("WAV", None),
+    "mp3": ("MP3", None),
+    "opus": ("OGG", "OPUS"),
+}
+DEFAULT_AUDIO_FORMAT = "flac"
+
+# Run dummy generations during init so the first job doesn't pay autotune/compile cost
+WARMUP = _env_bool("ACESTEP_WARMUP", True)
+WARMUP_DURATION = 10
+
+# Micro-batching of concurrent jobs (RunPod concurrency_modifier); 1 disables batching
+BATCH_MAX = int(os.getenv("ACESTEP_BATCH_MAX", "1"))
+BATCH_WAIT_MS = float(os.getenv("ACESTEP_BATCH_WAIT_MS", "10"))
+
+
+def bucket_duration(duration):
+    """Round a duration up to the nearest compile bucket (unchanged if above all buckets)"""
+    for bucket in DURATION_BUCKETS:
+        if duration <= bucket:
+            return bucket
+    return duration
+
+
+def trim_to_duration(audio, duration, sample_rate=SAMPLE_RATE):
+    """Trim bucket-padded audio back to the requested duration along its time axis"""
+    time_axis = max(range(audio.ndim), key=lambda d: audio.shape[d])
+    index = [slice(None)] * audio.ndim
+    index[time_axis] = slice(0, int(duration * sample_rate))
+    return audio[tuple(index)]
+
+
+def _transformer_of(pipe):
+    for name in ("transformer", "dit"):
+        module = getattr(pipe, name, None)
+        if isinstance(module, torch.nn.Module):
+            return module
+    return None
+
+
+def uses_bf16_weights():
+    """Whether init casts any pipeline weights to bf16 (only when opted in via quantization or BF16_VAE)"""
+    return torch.cuda.is_available() and (QUANTIZATION not in ("", "none") or BF16_VAE)
+
+
+def autocast_context():
+    """bf16 autocast around generation when weights are bf16, so the pipeline's fp32 inputs match"""
+    if uses_bf16_weights():
+        return torch.autocast("cuda", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def attention_context():
+    """Restrict scaled_dot_product_attention to fused backends on CUDA"""
+    if torch.cuda.is_available():
+        return sdpa_kernel(SDPA_BACKENDS)
+    return contextlib.nullcontext()
+
+
+def use_sdpa_attention(pipe):
+    """Route HF-style eager attention through scaled_dot_product_attention"""
+    transformer = _transformer_of(pipe)
+    config = getattr(transformer, "config", None)
+    if config is not None and getattr(config, "_attn_implementation", None) == "eager":
+        config._attn_implementation = "sdpa"
+        print("Switched transformer attention from eager to sdpa", flush=True)
+    return pipe
+
+
+def quantize_pipeline(pipe):
+    """If quantization is enabled, cast the transformer to bf16 and quantize its linears (weight-only)"""
+    transformer = _transformer_of(pipe)
+    if transformer is None or not torch.cuda.is_available() or QUANTIZATION in ("", "none"):
+        return pipe
+
+    # Resolve the quantization config before touching the module so a bad setting leaves it unmodified
+    from torchao.quantization import quantize_
+    if QUANTIZATION == "int8_weight_only":
+        from torchao.quantization import Int8WeightOnlyConfig
+        quant_config = Int8WeightOnlyConfig()
+    elif QUANTIZATION == "fp8_weight_only":
+        from torchao.quantization import Float8WeightOnlyConfig
+        quant_config = Float8WeightOnlyConfig()
+    else:
+        raise ValueError(f"Unsupported quantization type: {QUANTIZATION}")
+
+    # Inputs are cast by autocast_context() during generation
+    transformer.to(torch.bfloat16)
+    print("Cast transformer to bfloat16", flush=True)
+
+    def _should_quantize(module, fqn):
+        return isinstance(module, torch.nn.Linear) and not any(p in fqn for p in QUANT_SKIP_PATTERNS)
+
+    quantize_(transformer, quant_config, filter_fn=_should_quantize)
+    print(f"Transformer quantized with: {QUANTIZATION}", flush=True)
+    return pipe
+
+
+def use_bf16_vae(pipe):
+    """Opt-in (ACESTEP_BF16_VAE): decode in bf16; latents are cast by autocast_context() during generation"""
+    vae = getattr(pipe, "vae", None)
+    if BF16_VAE and isinstance(vae, torch.nn.Module) and torch.cuda.is_available():
+        vae.to(torch.bfloat16)
+        print("Cast VAE to bfloat16", flush=True)
+    return pipe
+
+
+def use_channels_last(pipe):
+    """Switch a conv-based VAE to NHWC/NDHWC layout for cuDNN's faster kernels"""
+    vae = getattr(pipe, "vae", None)
+    if not isinstance(vae, torch.nn.Module) or not torch.cuda.is_available():
+        return pipe
+    # Conv1d has no channels_last layout, so 1D (Oobleck-style) VAEs are left untouched
+    converted = 0
+    for module in vae.modules():
+        if isinstance(module, torch.nn.Conv3d):
+            module.to(memory_format=torch.channels_last_3d)
+            converted += 1
+        elif isinstance(module, torch.nn.Conv2d):
+            module.to(memory_format=torch.channels_last)
+            converted += 1
+    if converted:
+        print(f"Converted {converted} VAE conv layers to channels_last", flush=True)
+    return pipe
+
+
+def compile_pipeline(pipe):
+    """Wrap the pipeline's heavy submodules with torch.compile"""
+    # No CUDA graphs: guided sampling calls the transformer twice per step (cond/uncond), and a
+    # second graph replay would overwrite the first call's still-live output
+    compile_kwargs = dict(mode="max-autotune-no-cudagraphs", fullgraph=True, dynamic=False)
+    for name in ("transformer", "dit"):
+        module = getattr(pipe, name, None)
+        if isinstance(module, torch.nn.Module):
+            setattr(pipe, name, torch.compile(module, **compile_kwargs))
+            print(f"Compiled pipeline.{name}", flush=True)
+    text_encoder = getattr(pipe, "text_encoder", None)
+    if isinstance(text_encoder, torch.nn.Module):
+        # Token length follows the prompt, which duration buckets don't fix, so no static
+        # shapes / CUDA graphs here: one dynamic graph instead of a recompile per prompt length
+        pipe.text_encoder = torch.compile(text_encoder, dynamic=True)
+        print("Compiled pipeline.text_encoder (dynamic shapes)", flush=True)
+    vae = getattr(pipe, "vae", None)
+    if isinstance(vae, torch.nn.Module) and hasattr(vae, "decode"):
+        # The pipeline calls vae.decode() rather than forward(), so compile that method
+        vae.decode = torch.compile(vae.decode, **compile_kwargs)
+        print("Compiled pipeline.vae.decode", flush=True)
+    return pipe
+
+
+def accepts_generator(pipe):
+    """
+    Whether the pipeline's call declares an explicit generator parameter.
+
+    nn.Module.__call__ is (*args, **kwargs), so Modules are inspected through forward().
+    A bare **kwargs doesn't count: such a pipeline may silently drop the generator, so it
+    keeps the global torch.manual_seed fallback.
+    """
+    target = pipe.forward if isinstance(pipe, torch.nn.Module) else type(pipe).__call__
+    try:
+        params = inspect.signature(target).parameters
+    except (TypeError, ValueError):
+        return False
+    param = params.get("generator")
+    return param is not None and param.kind != inspect.Parameter.POSITIONAL_ONLY
+
+
+def uses_batch_path():
+    """
+    Whether jobs go through generate_batch, including lone jobs, so warmup and every job
+    share one (padded) input shape when the batcher is active.
+    """
+    return BATCH_MAX > 1 and pipeline_accepts_generator
+
+
+def make_generator(seed):
+    """Per-job RNG so seeding never touches global torch state (randomly seeded if seed is None)"""
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    generator = torch.Generator(device=device)
+    if seed is None:
+        generator.seed()
+    else:
+        generator.manual_seed(int(seed))
+    return generator
+
+
+def warmup_pipeline(pipe):
+    """Run a throwaway generation per static shape to populate kernel/graph caches"""
+    torch.backends.cudnn.benchmark = True
+    durations = DURATION_BUCKETS if COMPILE_MODEL else (WARMUP_DURATION,)
+    for duration in durations:
+        print(f"Warming up pipeline ({duration}s)...", flush=True)
+        request = {
+            "id": "warmup",
+            "prompt": "warmup",
+            "duration": duration,
+            "gen_duration": duration,
+            "inference_steps": 8,
+            "guidance_scale": 15,
+            "seed": None,
+            "format": DEFAULT_AUDIO_FORMAT,
+        }
+        try:
+            # Go through the same generate/encode path (and batch shape) that jobs will use
+            if uses_batch_path():
+                audio = generate_batch(pipe, [request])[0]
+            else:
+                audio = generate_single(pipe, request)
+            encode_audio(audio, request)
+        except Exception as e:
+            # Warmup runs the exact job path, so a failure here means jobs would fail too;
+            # re-raise so init_pipeline leaves the pipeline unpublished and the next job retries
+            print(f"Warmup failed for {duration}s: {e}", flush=True)
+            print(f"Traceback: {traceback.format_exc()}", flush=True)
+            raise
+    print("Pipeline warmup complete", flush=True)
+
 # Initialize the pipeline once at startup
 pipeline = None
+# Cached accepts_generator(pipeline), resolved once at init
+pipeline_accepts_generator = False
 
 def init_pipeline():
     """Initialize ACE-Step 1.5 pipeline"""
-    global pipeline
+    global pipeline, pipeline_accepts_generator
     if pipeline is None:
         print("Initializing ACE-Step 1.5 pipeline...", flush=True)
+        module_name = PIPELINE_BACKENDS.get(BACKEND)
+        if module_name is None:
+            raise ValueError(f"Unknown ACESTEP_BACKEND '{BACKEND}', expected one of {sorted(PIPELINE_BACKENDS)}")
         try:
-            # ACE-Step 1.5 uses acestep.pipeline module
-            from acestep.pipeline import ACEStepPipeline
-            pipeline = ACEStepPipeline()
+            print(f"Loading ACEStepPipeline from {module_name} (backend: {BACKEND})", flush=True)
+            ACEStepPipeline = importlib.import_module(module_name).ACEStepPipeline
+            pipe = ACEStepPipeline()
             print("ACE-Step 1.5 pipeline initialized successfully", flush=True)
-        except ImportError as e:
-            print(f"Import error: {e}", flush=True)
-            print(f"Traceback: {traceback.format_exc()}", flush=True)
-            # Try alternative import paths
-            try:
-                print("Trying alternative import: acestep.acestep_v15_pipeline", flush=True)
-                from acestep.acestep_v15_pipeline import ACEStepPipeline
-                pipeline = ACEStepPipeline()
-                print("Alternative import successful", flush=True)
-            except ImportError as e2:
-                print(f"Alternative import also failed: {e2}", flush=True)
-                print(f"Traceback: {traceback.format_exc()}", flush=True)
-                raise
+            pipeline_accepts_generator = accepts_generator(pipe)
+            print(f"Pipeline accepts a per-job generator: {pipeline_accepts_generator}", flush=True)
+
+            # Inference-only worker: no autograd, eval-mode modules, TF32 for any fp32 GEMMs
+            torch.set_grad_enabled(False)
+            if hasattr(pipe, "eval"):
+                pipe.eval()
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+
+            use_sdpa_attention(pipe)
+
+            # Quantize before compiling so Inductor sees the quantized weights
+            quantize_pipeline(pipe)
+
+            use_bf16_vae(pipe)
+            use_channels_last(pipe)
+
+            if COMPILE_MODEL:
+                print(f"Compiling pipeline (duration buckets: {DURATION_BUCKETS})...", flush=True)
+                compile_pipeline(pipe)
+
+            if WARMUP:
+                warmup_pipeline(pipe)
         except Exception as e:
             print(f"Error initializing pipeline: {e}", flush=True)
             print(f"Traceback: {traceback.format_exc()}", flush=True)
             raise
-    return pipeline
-
-def handler(job):
-    """
-    RunPod handler function
 
-    Input:
-    {
-        "tags": "warm, heartfelt, acoustic guitar, 90 BPM",
-        "lyrics": "[verse]\nThis is a song...\n[chorus]\n...",
-        "duration": 180,
-        "inference_steps": 8,
-        "guidance_scale": 15,
-        "seed": null
-    }
+        # Publish only a fully configured pipeline so a failed setup is retried from scratch
+        pipeline = pipe
+    return pipeline
 
-    Output:
-    {
-        "audio_base64": "base64-encoded-audio",
-        "duration": 180,
-        "filename": "task_id.wav"
-    }
-    """
+def parse_job(job):
+    """Extract generation parameters from a RunPod job"""
     print(f"Received job: {job['id']}", flush=True)
     job_input = job["input"]
     print(f"Job input: {job_input}", flush=True)
@@ -94,65 +482,257 @@ def handler(job):
     # Extract parameters
     tags = job_input.get("tags", "")
     lyrics = job_input.get("lyrics", "")
-    duration = job_input.get("duration", 180)
-    inference_steps = job_input.get("inference_steps", 8)
-    guidance_scale = job_input.get("guidance_scale", 15)
-    seed = job_input.get("seed")
+    audio_format = str(job_input.get("format", DEFAULT_AUDIO_FORMAT)).lower()
+    if audio_format not in AUDIO_FORMATS:
+        print(f"Unsupported format {audio_format}, using {DEFAULT_AUDIO_FORMAT}", flush=True)
+        audio_format = DEFAULT_AUDIO_FORMAT
 
     # Combine tags and lyrics into prompt
     prompt = f"{tags}\n\n{lyrics}" if tags else lyrics
     print(f"Generated prompt ({len(prompt)} chars)", flush=True)
 
-    try:
-        # Initialize pipeline
-        pipe = init_pipeline()
+    duration = job_input.get("duration", 180)
+    return {
+        "id": job["id"],
+        "prompt": prompt,
+        "duration": duration,
+        # Compiled graphs are specialized to static shapes; pad to a bucket and trim afterwards
+        "gen_duration": bucket_duration(duration) if COMPILE_MODEL else duration,
+        "inference_steps": job_input.get("inference_steps", 8),
+        "guidance_scale": job_input.get("guidance_scale", 15),
+        "seed": job_input.get("seed"),
+        "format": audio_format,
+    }
 
-        # Set seed if provided
-        if seed is not None:
+
+def batch_key(request):
+    """Requests can share a pipeline call only if everything but prompt and seed matches"""
+    return (request["gen_duration"], request["inference_steps"], request["guidance_scale"])
+
+
+def generate_single(pipe, request):
+    """Generate audio for one request"""
+    # Seed a per-job generator if provided; fall back to the global seed for pipelines without one
+    seed = request["seed"]
+    generate_kwargs = {}
+    if seed is not None:
+        if pipeline_accepts_generator:
+            generate_kwargs["generator"] = make_generator(seed)
+        else:
             torch.manual_seed(seed)
-            print(f"Set random seed: {seed}", flush=True)
+        print(f"Set random seed: {seed}", flush=True)
+
+    # Generate audio
+    print(f"Generating {request['gen_duration']}s audio with {request['inference_steps']} steps, guidance={request['guidance_scale']}...", flush=True)
+
+    with torch.inference_mode(), attention_context(), autocast_context():
+        audio = pipe(
+            prompt=request["prompt"],
+            duration=request["gen_duration"],
+            num_inference_steps=request["inference_steps"],
+            guidance_scale=request["guidance_scale"],
+            **generate_kwargs,
+        )
+
+    print(f"Audio generated, shape: {audio.shape if hasattr(audio, 'shape') else 'unknown'}", flush=True)
+    return audio
 
-        # Generate audio
-        print(f"Generating {duration}s audio with {inference_steps} steps, guidance={guidance_scale}...", flush=True)
 
+def generate_batch(pipe, requests):
+    """Generate audio for requests sharing a batch_key in one pipeline call"""
+    prompts = [r["prompt"] for r in requests]
+    generators = [make_generator(r["seed"]) for r in requests]
+    if COMPILE_MODEL:
+        # Keep the batch dimension static so compiled graphs are reused across batch sizes
+        while len(prompts) < BATCH_MAX:
+            prompts.append(prompts[-1])
+            generators.append(make_generator(None))
+
+    first = requests[0]
+    print(f"Generating batch of {len(requests)} x {first['gen_duration']}s audio with {first['inference_steps']} steps, guidance={first['guidance_scale']}...", flush=True)
+
+    with torch.inference_mode(), attention_context(), autocast_context():
         audio = pipe(
-            prompt=prompt,
-            duration=duration,
-            num_inference_steps=inference_steps,
-            guidance_scale=guidance_scale,
+            prompt=prompts,
+            duration=first["gen_duration"],
+            num_inference_steps=first["inference_steps"],
+            guidance_scale=first["guidance_scale"],
+            generator=generators,
         )
 
-        print(f"Audio generated, shape: {audio.shape if hasattr(audio, 'shape') else 'unknown'}", flush=True)
+    print(f"Batch generated, shape: {audio.shape if hasattr(audio, 'shape') else 'unknown'}", flush=True)
+    return [audio[i] for i in range(len(requests))]
+
 
-        # Convert to bytes
-        audio_buffer = io.BytesIO()
+def encode_audio(audio, request):
+    """Trim, quantize and encode one generated clip into the job's response payload"""
+    duration = request["duration"]
+    audio_format = request["format"]
+    if request["gen_duration"] != duration:
+        audio = trim_to_duration(audio, duration)
+
+    # Convert to bytes, reusing the worker's encode buffer
+    audio_buffer = _audio_buffer
+    audio_buffer.seek(0)
+    audio_buffer.truncate()
+
+    # ACE-Step typically returns float32 audio in range [-1, 1]
+    if isinstance(audio, torch.Tensor) and audio.is_cuda:
+        # Normalize on GPU so only the int16 buffer crosses PCIe
+        audio_int16 = to_int16_gpu(audio)
+    else:
+        # numpy has no bf16, so CPU tensors are upcast before conversion
+        audio_np = audio.float().numpy() if isinstance(audio, torch.Tensor) else audio
+        # Convert to int16 PCM (peak check + scale + cast in one pass)
+        audio_int16 = to_int16(audio_np)
+
+    if audio_format == "wav":
+        write_wav(audio_buffer, SAMPLE_RATE, audio_int16)
+    else:
+        # soundfile expects [samples, channels]; ACE-Step audio is [channels, samples] (see AudioSaver)
+        if audio_int16.ndim == 2:
+            audio_int16 = np.ascontiguousarray(audio_int16.T)
+        sf_format, sf_subtype = AUDIO_FORMATS[audio_format]
+        sf.write(audio_buffer, audio_int16, SAMPLE_RATE, format=sf_format, subtype=sf_subtype)
+
+    # Encode as base64 straight from the buffer's memory (no intermediate bytes copy)
+    with audio_buffer.getbuffer() as audio_view:
+        print(f"Audio converted to {audio_format.upper()}: {audio_view.nbytes} bytes", flush=True)
+        audio_base64 = base64.b64encode(audio_view).decode("ascii")
+    print(f"Audio encoded to base64: {len(audio_base64)} chars", flush=True)
+
+    return {
+        "audio_base64": audio_base64,
+        "duration": duration,
+        "filename": f"{request['id']}.{audio_format}",
+        "format": audio_format,
+        "sample_rate": SAMPLE_RATE,
+    }
 
-        # Ensure audio is in the right format for wavfile.write
-        # ACE-Step typically returns float32 audio in range [-1, 1]
-        if hasattr(audio, 'numpy'):
-            audio_np = audio.numpy()
+
+def run_requests(requests):
+    """Generate and encode a group of requests sharing a batch_key"""
+    pipe = init_pipeline()
+    if uses_batch_path():
+        audios = generate_batch(pipe, requests)
+    else:
+        # Per-request seeding needs a generator kwarg, so run sequentially without one
+        audios = [generate_single(pipe, r) for r in requests]
+    return [encode_audio(audio, r) for audio, r in zip(audios, requests)]
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrently submitted jobs into batched pipeline calls.
+
+    A single worker thread owns the pipeline and the shared encode buffers, so jobs
+    never touch them concurrently.
+    """
+
+    def __init__(self, max_batch, wait_ms):
+        self.max_batch = max_batch
+        self.wait_s = wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._loop, name="acestep-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, request):
+        future = concurrent.futures.Future()
+        self._queue.put((request, future))
+        return future
+
+    def _drain(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.wait_s
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            groups = {}
+            for request, future in self._drain():
+                # Drops jobs RunPod already cancelled/timed out; the rest can no longer be cancelled
+                if future.set_running_or_notify_cancel():
+                    groups.setdefault(batch_key(request), []).append((request, future))
+            for items in groups.values():
+                try:
+                    self._run_group(items)
+                except Exception as e:
+                    # Never let one group take down the thread every later job waits on
+                    print(f"Batcher error: {e}", flush=True)
+                    print(f"Traceback: {traceback.format_exc()}", flush=True)
+                    for _, future in items:
+                        _resolve(future, exception=e)
+
+    def _run_group(self, items):
+        try:
+            results = run_requests([request for request, _ in items])
+        except Exception as e:
+            for _, future in items:
+                _resolve(future, exception=e)
+            return
+        for (_, future), result in zip(items, results):
+            _resolve(future, result=result)
+
+
+def _resolve(future, result=None, exception=None):
+    """Complete a batcher future, ignoring ones that were already resolved"""
+    try:
+        if exception is not None:
+            future.set_exception(exception)
         else:
-            audio_np = audio
+            future.set_result(result)
+    except concurrent.futures.InvalidStateError:
+        pass
 
-        # Convert to int16 for WAV
-        import numpy as np
-        audio_int16 = (audio_np * 32767).astype(np.int16)
 
-        wavfile.write(audio_buffer, 44100, audio_int16)
-        audio_bytes = audio_buffer.getvalue()
-        print(f"Audio converted to WAV: {len(audio_bytes)} bytes", flush=True)
+batcher = None
 
-        # Encode as base64
-        audio_base64 = base64.b64encode(audio_bytes).decode("utf-8")
-        print(f"Audio encoded to base64: {len(audio_base64)} chars", flush=True)
 
-        return {
-            "audio_base64": audio_base64,
-            "duration": duration,
-            "filename": f"{job['id']}.wav",
-            "sample_rate": 44100,
-        }
+def handler(job):
+    """
+    RunPod handler function
+
+    Input:
+    {
+        "tags": "warm, heartfelt, acoustic guitar, 90 BPM",
+        "lyrics": "[verse]\nThis is a song...\n[chorus]\n...",
+        "duration": 180,
+        "inference_steps": 8,
+        "guidance_scale": 15,
+        "seed": null,
+        "format": "flac"
+    }
+
+    Output:
+    {
+        "audio_base64": "base64-encoded-audio",
+        "duration": 180,
+        "filename": "task_id.flac",
+        "format": "flac"
+    }
+    """
+    request = parse_job(job)
+    try:
+        return run_requests([request])[0]
+    except Exception as e:
+        print(f"Error generating audio: {e}", flush=True)
+        print(f"Traceback: {traceback.format_exc()}", flush=True)
+        raise e
+
 
+async def batched_handler(job):
+    """RunPod handler used when ACESTEP_BATCH_MAX > 1; same input/output as handler()"""
+    request = parse_job(job)
+    try:
+        return await asyncio.wrap_future(batcher.submit(request))
     except Exception as e:
         print(f"Error generating audio: {e}", flush=True)
         print(f"Traceback: {traceback.format_exc()}", flush=True)
@@ -168,6 +748,30 @@ try:
 except ImportError as e:
     print(f"WARNING: acestep module not found: {e}", flush=True)
 
+# Load and warm up the pipeline during cold start rather than on the first job
+try:
+    init_pipeline()
+except Exception as e:
+    print(f"WARNING: pipeline initialization failed, will retry on first job: {e}", flush=True)
+
+# Batching needs per-job generators; decide once, after init, whether this pipeline can batch
+if BATCH_MAX > 1 and not (pipeline is not None and pipeline_accepts_generator):
+    print(
+        f"WARNING: ACESTEP_BATCH_MAX={BATCH_MAX} ignored "
+        f"({'pipeline failed to initialize' if pipeline is None else 'pipeline has no generator parameter'}); "
+        "serving one job at a time",
+        flush=True,
+    )
+    BATCH_MAX = 1
+
 # Start the serverless worker
 print("Starting RunPod serverless worker...", flush=True)
-runpod.serverless.start({"handler": handler})
+if BATCH_MAX > 1:
+    print(f"Micro-batching up to {BATCH_MAX} concurrent jobs ({BATCH_WAIT_MS}ms window)", flush=True)
+    batcher = MicroBatcher(BATCH_MAX, BATCH_WAIT_MS)
+    runpod.serverless.start({
+        "handler": batched_handler,
+        "concurrency_modifier": lambda current_concurrency: BATCH_MAX,
+    })
+else:
+    runpod.serverless.start({"handler": handler})